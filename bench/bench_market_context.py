@@ -0,0 +1,67 @@
+# bench/bench_market_context.py
+"""跨币种概况基准：测量 build_market_context、成交后刷新敞口与逐币种格式化的耗时
+
+用法: python bench/bench_market_context.py [--symbols 10 100 500] [--bars 49]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from market_context import build_market_context, format_market_context, update_context_positions # noqa: E402
+
+
+def synthetic_market(num_symbols, bars, seed=0):
+    """生成与 BTC 因子相关的随机游走K线和随机持仓"""
+    rng = np.random.default_rng(seed)
+    market = rng.normal(0, 0.004, bars)
+    timestamps = np.arange(bars, dtype=np.int64) * 15 * 60 * 1000
+    candles_by_symbol = {}
+    positions = {}
+    for k in range(num_symbols):
+        symbol = 'BTC/USDT' if k == 0 else f'COIN{k}/USDT'
+        loading = 1.0 if k == 0 else rng.uniform(0.3, 1.5)
+        returns = loading * market + rng.normal(0, 0.003, bars)
+        candles_by_symbol[symbol] = (timestamps, rng.uniform(0.1, 70000) * np.exp(np.cumsum(returns)))
+        if rng.random() < 0.2:
+            positions[symbol] = {'side': 'long' if rng.random() < 0.5 else 'short', 'size': rng.uniform(0.01, 10), 'entry_price': 1.0}
+        else:
+            positions[symbol] = None
+    return candles_by_symbol, positions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--symbols', type=int, nargs='+', default=[10, 100, 300, 500], help='币种数量')
+    parser.add_argument('--bars', type=int, default=49, help='每个币种的K线数量')
+    parser.add_argument('--rounds', type=int, default=20, help='重复次数 (取中位数)')
+    args = parser.parse_args()
+
+    for num_symbols in args.symbols:
+        candles_by_symbol, positions = synthetic_market(num_symbols, args.bars)
+        build_times = []
+        update_times = []
+        format_times = []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            context = build_market_context(candles_by_symbol, positions, bars=args.bars)
+            build_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            update_context_positions(context, positions)
+            update_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            for symbol in candles_by_symbol:
+                format_market_context(context, symbol)
+            format_times.append(time.perf_counter() - start)
+        build_ms = float(np.median(build_times)) * 1000
+        update_ms = float(np.median(update_times)) * 1000
+        format_ms = float(np.median(format_times)) * 1000
+        print(f"{num_symbols:>5} 个币种 x {args.bars} 根K线: 计算 {build_ms:7.2f} ms, "
+              f"刷新敞口 {update_ms:6.2f} ms, 全部格式化 {format_ms:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# bench/bench_signal_parser.py
+"""信号解析基准：在畸形回复语料上测量解析吞吐量与成功率
+
+用法: python bench/bench_signal_parser.py [--rounds 2000]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signal_parser import decode_signal, parse_json_reply # noqa: E402
+
+try:
+    import json5
+except ImportError:
+    json5 = None
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'signal_corpus.jsonl')
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def legacy_parse(text):
+    """旧版解析级联 (json -> json5 -> 正则修复)，仅用于对比"""
+    start_idx = text.find('{')
+    end_idx = text.rfind('}') + 1
+    if start_idx == -1 or end_idx == 0:
+        return None
+    json_str = text[start_idx:end_idx]
+    try:
+        return json.loads(json_str)
+    except json.JSONDecodeError:
+        pass
+    if json5 is not None:
+        try:
+            return json5.loads(json_str)
+        except ValueError:
+            pass
+    repaired_json_str = re.sub(r"('|\")(\w+)('|\")(\s*:\s*)('|\")", r'"\2"\4"', json_str)
+    try:
+        return json.loads(repaired_json_str)
+    except json.JSONDecodeError:
+        return None
+
+
+def new_parse(text):
+    try:
+        return parse_json_reply(text)
+    except ValueError:
+        return None
+
+
+def expected_outcome(case):
+    signal_data, errors = decode_signal(case['reply'], case['price'])
+    if signal_data is not None:
+        return 'valid'
+    return 'unparseable' if new_parse(case['reply']) is None else 'invalid'
+
+
+def bench(name, func, corpus, rounds):
+    parsed = sum(1 for case in corpus if func(case) is not None)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for case in corpus:
+            func(case)
+    elapsed = time.perf_counter() - start
+    total = rounds * len(corpus)
+    print(f"{name:<28} 解析成功 {parsed:>2}/{len(corpus)} ({parsed / len(corpus) * 100:5.1f}%)  "
+          f"吞吐 {total / elapsed:>10,.0f} 条/秒  平均 {elapsed / total * 1e6:7.1f} µs/条")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=2000, help='每个解析器遍历语料的轮数')
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    print(f"语料: {len(corpus)} 条, 轮数: {args.rounds}, json5: {'已安装' if json5 else '未安装 (旧版级联跳过该步)'}")
+    print("-" * 100)
+    bench("旧版级联 (json/json5/正则)", lambda c: legacy_parse(c['reply']), corpus, args.rounds)
+    bench("新版解析 (json/宽容改写)", lambda c: new_parse(c['reply']), corpus, args.rounds)
+    bench("新版解析 + 结构校验", lambda c: decode_signal(c['reply'], c['price'])[0], corpus, args.rounds)
+    print("-" * 100)
+
+    mismatches = [case['name'] for case in corpus if expected_outcome(case) != case['expect']]
+    valid = sum(1 for case in corpus if case['expect'] == 'valid')
+    print(f"可直接使用的信号: {valid}/{len(corpus)}, 其余 {len(corpus) - valid} 条将触发修复请求")
+    if mismatches:
+        print(f"[WARNING] 与语料预期不符: {mismatches}")
+        sys.exit(1)
+    print("所有语料均符合预期。")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,13 @@
 import os
 import time
 import schedule
-from openai import OpenAI
+from openai import OpenAI, BadRequestError
 import ccxt
 import pandas as pd
 from datetime import datetime
-import json
-import json5  # 用于解析可能非标准的JSON
 import math   # 用于数学计算 (floor) - Essential import
+from signal_parser import decode_signal, validate_signal, build_repair_prompt # LLM 信号解析与校验
+from market_context import build_market_context, format_market_context, update_context_positions # 跨币种市场概况
 # 注意：feedparser 的导入被移到了后面，且变为条件性导入
 
 # 1. 首先加载 .env 文件
@@ -33,10 +33,13 @@ else:
 LLM_API_KEY = os.getenv('LLM_API_KEY')
 LLM_BASE_URL = os.getenv('LLM_BASE_URL', 'https://api.deepseek.com') # 提供默认值
 LLM_MODEL_NAME = os.getenv('LLM_MODEL_NAME', 'deepseek-chat')       # 提供默认值
+# 是否请求 JSON 结构化输出 (response_format=json_object)，不支持的服务商会自动回退
+LLM_JSON_MODE = os.getenv('LLM_JSON_MODE', 'True').lower() in ['true', '1', 'yes', 'on']
 
 print(f"[CONFIG] LLM API Key: {'*' * len(LLM_API_KEY) if LLM_API_KEY else 'NOT SET'}")
 print(f"[CONFIG] LLM Base URL: {LLM_BASE_URL}")
 print(f"[CONFIG] LLM Model Name: {LLM_MODEL_NAME}")
+print(f"[CONFIG] LLM JSON Mode: {LLM_JSON_MODE}")
 
 # --- 初始化 LLM 客户端 (OpenAI 兼容) ---
 llm_client = OpenAI(
@@ -106,6 +109,12 @@ def parse_risk_management_config():
 RISK_MANAGEMENT_CONFIG = parse_risk_management_config()
 print(f"[CONFIG] 风险管理配置: {RISK_MANAGEMENT_CONFIG}")
 
+# --- 从 .env 读取跨币种市场概况配置 ---
+ENABLE_MARKET_CONTEXT = os.getenv('ENABLE_MARKET_CONTEXT', 'True').lower() in ['true', '1', 'yes', 'on']
+MARKET_CONTEXT_BARS = int(os.getenv('MARKET_CONTEXT_BARS', '48'))                  # 计算相关性使用的K线数量
+MARKET_CONTEXT_BENCHMARK = os.getenv('MARKET_CONTEXT_BENCHMARK', 'BTC/USDT')      # 相对强弱的基准币种
+print(f"[CONFIG] 跨币种市场概况: {ENABLE_MARKET_CONTEXT}, K线数量: {MARKET_CONTEXT_BARS}, 基准: {MARKET_CONTEXT_BENCHMARK}")
+
 # --- 全局变量 (改为字典以支持多币种) ---
 price_history = {symbol: [] for symbol in TRADE_CONFIG.keys()}
 signal_history = {symbol: [] for symbol in TRADE_CONFIG.keys()}
@@ -173,7 +182,9 @@ def get_ohlcv(symbol, timeframe='15m', limit=10):
             'volume': current_data['volume'],
             'timeframe': timeframe,
             'price_change': ((current_data['close'] - previous_data['close']) / previous_data['close']) * 100,
-            'kline_data': df[['timestamp', 'open', 'high', 'low', 'close', 'volume']].tail(5).to_dict('records')
+            'kline_data': df[['timestamp', 'open', 'high', 'low', 'close', 'volume']].tail(5).to_dict('records'),
+            'timestamps': df['timestamp'].to_numpy(), # K线时间戳，跨币种概况用于对齐
+            'closes': df['close'].to_numpy(dtype=float) # 完整收盘价序列，供跨币种概况使用
         }
     except Exception as e:
         print(f"获取 {symbol} K线数据失败: {e}")
@@ -283,8 +294,57 @@ if ENABLE_NEWS:
             print(f"[NEWS CHECK] 在 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} 新闻内容无变化，跳过更新。")
 # --- 修改结束 ---
 
-def analyze_with_deepseek(price_data):
-    """使用LLM分析指定币种的市场并生成交易信号"""
+def create_llm_completion(messages, **kwargs):
+    """调用 LLM，启用 JSON 模式时请求结构化输出；服务商不支持时关闭 JSON 模式并重试"""
+    global LLM_JSON_MODE
+    if LLM_JSON_MODE:
+        try:
+            return llm_client.chat.completions.create(
+                model=LLM_MODEL_NAME,
+                messages=messages,
+                response_format={"type": "json_object"},
+                stream=False,
+                **kwargs
+            )
+        except BadRequestError as e:
+            # 只有 response_format 本身被拒绝时才回退；上下文超长、内容过滤等错误原样抛出
+            message = str(e).lower()
+            if getattr(e, 'param', None) != 'response_format' and 'response_format' not in message and 'json_object' not in message:
+                raise
+            print(f"[WARNING] 当前 LLM 服务不支持 JSON 模式，已自动关闭: {e}")
+            LLM_JSON_MODE = False
+    return llm_client.chat.completions.create(
+        model=LLM_MODEL_NAME,
+        messages=messages,
+        stream=False,
+        **kwargs
+    )
+
+def repair_signal_reply(symbol, bad_reply, errors, current_price):
+    """解析或校验失败时，请求 LLM 只修正格式 (不重新分析)，返回 (signal_data, errors)"""
+    print(f"[REPAIR] {symbol} 的回复未通过校验，请求修复: {errors}")
+    try:
+        response = create_llm_completion(
+            [
+                {"role": "system", "content": "你是JSON格式修复器，只输出一个符合要求的JSON对象。"},
+                {"role": "user", "content": build_repair_prompt(bad_reply, errors)}
+            ],
+            temperature=0,
+            max_tokens=800
+        )
+        repaired = response.choices[0].message.content or ""
+        print(f"[REPAIR] {symbol} 修复后回复:\n{repaired}")
+    except Exception as e:
+        print(f"[ERROR] {symbol} 修复请求失败: {e}")
+        return None, errors
+    return decode_signal(repaired, current_price)
+
+def analyze_with_deepseek(price_data, market_context_text="", all_current_positions=None):
+    """使用LLM分析指定币种的市场并生成交易信号
+
+    market_context_text 为本轮跨币种概况中截取的本币种部分；
+    all_current_positions 为本轮已获取的持仓，未提供时重新从API获取。
+    """
     symbol = price_data['symbol']
     # 添加当前价格到对应币种的历史记录
     price_history[symbol].append(price_data)
@@ -323,8 +383,9 @@ def analyze_with_deepseek(price_data):
         signal_text = "".join(signal_text_parts)
 
     # --- 关键修改：直接从API获取当前持仓信息 ---
-    # 调用 get_positions() 获取所有持仓
-    all_current_positions = get_positions()
+    # 调用 get_positions() 获取所有持仓 (本轮已获取时直接复用)
+    if all_current_positions is None:
+        all_current_positions = get_positions()
     # 从中提取当前 symbol 的持仓信息
     current_pos = all_current_positions.get(symbol)
     # --- 修改结束 ---
@@ -352,6 +413,7 @@ def analyze_with_deepseek(price_data):
     {indicator_text}
     {signal_text}
     {news_text} # 新增：将新闻信息加入Prompt (如果启用)
+    {market_context_text}
     【当前行情】
     - 当前价格: ${price_data['price']:,.2f}
     - 时间: {price_data['timestamp']}
@@ -373,7 +435,7 @@ def analyze_with_deepseek(price_data):
     【分析与决策要求】
     1.  **首要任务：风险评估**。在给出任何交易信号之前，**必须**详细说明本次交易所涉及的具体风险（例如：若按建议止损，将损失账户总资金的百分之多少）。
     2.  **交易信号**: BUY(买入) / SELL(卖出) / HOLD(观望)。
-    3.  **决策理由**：简要分析市场趋势、技术指标、成交量如何影响价格，并明确指出风险点。{"如果启用了新闻，请同时分析新闻事件对市场情绪和价格的潜在影响。" if ENABLE_NEWS else ""}
+    3.  **决策理由**：简要分析市场趋势、技术指标、成交量如何影响价格，并明确指出风险点。{"如果启用了新闻，请同时分析新闻事件对市场情绪和价格的潜在影响。" if ENABLE_NEWS else ""}{"请结合跨币种概况 (基准走势、相对强弱、与现有持仓的相关敞口) 判断，避免叠加高度相关的同向风险。" if market_context_text else ""}
     4.  **止损价位**: 基于技术分析和风险管理规则设定一个**坚决**的止损价格。
     5.  **止盈价位**: 基于技术分析和风险管理规则设定一个现实的止盈价格。
     6.  **信号信心**: HIGH(高) / MEDIUM(中) / LOW(低)，并说明原因。
@@ -405,74 +467,34 @@ def analyze_with_deepseek(price_data):
         你必须展现出**极度的冷静和风险厌恶**。在分析中，始终将保护本金放在首位。
         """
         # --- 修改结束 ---
-        # --- 关键修改：使用 llm_client 和 LLM_MODEL_NAME ---
-        response = llm_client.chat.completions.create(
-            model=LLM_MODEL_NAME, # 使用从 .env 读取的模型名
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            stream=False
-        )
+        # --- 关键修改：通过 create_llm_completion 调用 (JSON 模式可用时请求结构化输出) ---
+        response = create_llm_completion([
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ])
         # --- 修改结束 ---
 
-        result = response.choices[0].message.content
+        result = response.choices[0].message.content or ""
         # --- 新增：打印 LLM 的完整原始回复到日志 ---
         print(f"[THOUGHT PROCESS] LLM完整原始回复 for {symbol}:\n{result}")
         # --- 修改结束 ---
 
-        # --- 更健壮的JSON解析 (作用于 result) ---
-        signal_data = None
-        # 尝试提取最外层的JSON对象
-        start_idx = result.find('{')
-        end_idx = result.rfind('}') + 1
-        if start_idx == -1 or end_idx == 0:
-             print(f"在 {symbol} 的回复中未找到有效的JSON对象: {result}")
-             return None # 修正：找不到JSON对象时返回None
-        json_str = result[start_idx:end_idx]
-        # print(f"[DEBUG] 提取的JSON字符串 for {symbol}: {json_str}") # 可选：打印提取的JSON
-
-        # 首先尝试使用标准json库解析
-        try:
-            signal_data = json.loads(json_str)
-            # print(f"[DEBUG] 使用标准json库解析 {symbol} 成功") # 可选：打印解析结果
-        except json.JSONDecodeError as e:
-            # print(f"[DEBUG] 标准json库解析 {symbol} 失败: {e}") # 可选：打印解析结果
-            # 如果标准库失败，尝试使用json5库，它更宽容
-            try:
-                signal_data = json5.loads(json_str) # 修正：json5.loads 使用 ValueError
-                # print(f"[DEBUG] 使用json5库解析 {symbol} 成功") # 可选：打印解析结果
-            except ValueError as e2: # 修正：捕获 ValueError
-                # print(f"[DEBUG] json5库解析 {symbol} 也失败: {e2}") # 可选：打印解析结果
-                # 如果都失败了，尝试手动修复一些常见的问题（例如单引号）
-                # 这个修复非常基础，可能不适用于所有情况
-                import re
-                # 尝试将最外层的单引号键值对替换为双引号
-                # 这个正则表达式比较脆弱，仅作为最后手段
-                # 它查找 'key': 或 "key': 或 'key": 或 'key": 格式，并替换为 "key":
-                # 请注意，这可能会在值包含冒号时出错
-                repaired_json_str = re.sub(r"('|\")(\w+)('|\")(\s*:\s*)('|\")", r'"\2"\4"', json_str)
-                try:
-                    signal_data = json.loads(repaired_json_str)
-                    # print(f"[DEBUG] 使用简单修复后解析 {symbol} 成功") # 可选：打印解析结果
-                except json.JSONDecodeError as e3:
-                    # print(f"[DEBUG] 简单修复后解析 {symbol} 仍失败: {e3}") # 可选：打印解析结果
-                    print(f"解析 {symbol} 的LLM JSON回复失败: 所有方法均尝试但失败。") # 提示解析失败
-                    print(f"原始回复: {result}") # 打印原始回复以便检查
-                    print(f"尝试解析的JSON片段: {json_str}") # 打印尝试解析的片段
-                    return None # 修正：所有方法都失败时返回None
-                    # 所有方法都失败
+        # --- 解析并按信号结构校验 (数值强制转换、止损/止盈方向检查) ---
+        signal_data, errors = decode_signal(result, price_data['price'])
+        if signal_data is None:
+            # 不直接放弃本轮，发起一次只修复格式的低成本请求
+            signal_data, errors = repair_signal_reply(symbol, result, errors, price_data['price'])
+        if signal_data is None:
+            print(f"[ERROR] 未能成功解析 {symbol} 的信号数据: {errors}")
+            print(f"原始回复: {result}") # 打印原始回复以便检查
+            return None
 
         # --- 解析成功后的处理 ---
-        if signal_data: # 确保 signal_data 不是 None
-            signal_data['timestamp'] = price_data['timestamp']
-            signal_history[symbol].append(signal_data)
-            if len(signal_history[symbol]) > 30:
-                signal_history[symbol].pop(0)
-            return signal_data
-        else:
-            print(f"[ERROR] 未能成功解析 {symbol} 的信号数据。")
-            return None
+        signal_data['timestamp'] = price_data['timestamp']
+        signal_history[symbol].append(signal_data)
+        if len(signal_history[symbol]) > 30:
+            signal_history[symbol].pop(0)
+        return signal_data
     except Exception as e:
         print(f"[ERROR] LLM分析 {symbol} 失败: {e}")
         import traceback
@@ -480,7 +502,7 @@ def analyze_with_deepseek(price_data):
         return None
 
 def execute_trade(symbol, signal_data, price_data):
-    """执行指定币种的交易 (动态仓位)"""
+    """执行指定币种的交易 (动态仓位)，下单并刷新 positions[symbol] 后返回 True"""
     config = TRADE_CONFIG[symbol]
     # --- 关键修改：直接从API获取执行前的当前持仓信息 ---
     # 调用 get_positions() 获取所有持仓
@@ -616,20 +638,67 @@ def execute_trade(symbol, signal_data, price_data):
         all_pos = get_positions() # 调用修正后的函数
         positions[symbol] = all_pos.get(symbol) # 更新全局持仓字典
         print(f"{symbol} 更新后持仓: {format_position_info(positions[symbol])}") # 调用格式化函数
+        return True
 
     except Exception as e:
         print(f"{symbol} 订单执行失败: {e}")
         import traceback
         traceback.print_exc()
 
-def run_single_strategy(symbol):
-    """为单个币种运行完整的交易策略"""
+def run_market_context_stage():
+    """每轮执行一次：获取所有币种K线和持仓，批量计算跨币种市场概况
+
+    返回 (price_data_by_symbol, market_context, all_current_positions)。
+    K线和持仓在后续逐币种分析中直接复用，不产生额外的交易所请求。
+    """
+    limit = max(10, MARKET_CONTEXT_BARS)
+    price_data_by_symbol = {}
+    for symbol, config in TRADE_CONFIG.items():
+        price_data_by_symbol[symbol] = get_ohlcv(symbol, config['timeframe'], limit=limit)
+    all_current_positions = get_positions()
+
+    start = time.perf_counter()
+    candles_by_symbol = {symbol: (data['timestamps'], data['closes']) for symbol, data in price_data_by_symbol.items() if data}
+    market_context = build_market_context(candles_by_symbol, all_current_positions, MARKET_CONTEXT_BENCHMARK, MARKET_CONTEXT_BARS)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if market_context:
+        print(f"[MARKET CONTEXT] {len(market_context['symbols'])} 个币种, {market_context['bars']} 根K线, "
+              f"基准 {market_context['benchmark']}, 耗时 {elapsed_ms:.2f} ms")
+    else:
+        print("[MARKET CONTEXT] 可用币种或K线不足，本轮不生成跨币种概况。")
+    return price_data_by_symbol, market_context, all_current_positions
+
+def refresh_price_before_trade(symbol, signal_data, price_data):
+    """下单前用最新成交价复核信号 (K线可能在本轮开始时获取，已过去数分钟)
+
+    返回带最新价格的 price_data 副本供下单计算仓位 (price_history 中的记录保持不变)；
+    止损/止盈方向在最新价格下不成立时返回 None。
+    """
+    try:
+        ticker = exchange.fetch_ticker(symbol)
+        last_price = ticker.get('last')
+    except Exception as e:
+        print(f"[WARNING] 获取 {symbol} 最新价格失败，沿用K线价格: {e}")
+        return price_data
+    if not last_price:
+        return price_data
+    print(f"{symbol} 下单前最新价格: ${last_price:,.2f} (K线价格: ${price_data['price']:,.2f})")
+    _, errors = validate_signal(signal_data, last_price)
+    if errors:
+        print(f"[WARNING] {symbol} 信号在最新价格下已失效，取消交易: {errors}")
+        return None
+    return {**price_data, 'price': last_price}
+
+def run_single_strategy(symbol, price_data=None, market_context=None, all_current_positions=None):
+    """为单个币种运行完整的交易策略 (price_data 未提供时自行获取K线)，已下单时返回 True"""
     # 修正 print 语句中的换行符问题
     print("\n" + "=" * 60)
     print(f"执行时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, 交易对: {symbol}")
     print("=" * 60)
     config = TRADE_CONFIG[symbol]
-    price_data = get_ohlcv(symbol, config['timeframe'])
+    prefetched = price_data is not None # K线来自本轮开始时的跨币种阶段
+    if price_data is None:
+        price_data = get_ohlcv(symbol, config['timeframe'])
     if not price_data: # 修正语法错误：完整变量名
         print(f"获取 {symbol} 数据失败，跳过此次执行。")
         return
@@ -638,12 +707,18 @@ def run_single_strategy(symbol):
     print(f"数据周期: {config['timeframe']}")
     print(f"价格变化: {price_data['price_change']:+.2f}%")
 
-    signal_data = analyze_with_deepseek(price_data) # 无需传递news_text，从全局变量获取
+    market_context_text = format_market_context(market_context, symbol)
+    signal_data = analyze_with_deepseek(price_data, market_context_text, all_current_positions) # 无需传递news_text，从全局变量获取
     if not signal_data: # 修正语法错误：完整变量名
         print(f"分析 {symbol} 失败，跳过此次执行。")
         return
 
-    execute_trade(symbol, signal_data, price_data)
+    if prefetched and signal_data['signal'] in ('BUY', 'SELL'):
+        price_data = refresh_price_before_trade(symbol, signal_data, price_data)
+        if not price_data:
+            return
+
+    return execute_trade(symbol, signal_data, price_data)
 
 def main():
     """主函数"""
@@ -667,8 +742,22 @@ def main():
     def run_all_strategies():
         """为所有配置的币种运行一次策略，共享新闻"""
         # 不再在这里获取新闻，因为新闻由独立任务更新 (如果启用)
-        for symbol in TRADE_CONFIG.keys():
-            run_single_strategy(symbol) # 不再传递news_text参数
+        if ENABLE_MARKET_CONTEXT:
+            # 先运行一次跨币种阶段，再逐币种分析
+            price_data_by_symbol, market_context, all_current_positions = run_market_context_stage()
+            for symbol in TRADE_CONFIG.keys():
+                price_data = price_data_by_symbol.get(symbol)
+                if not price_data:
+                    print(f"获取 {symbol} 数据失败，跳过此次执行。")
+                    continue
+                if run_single_strategy(symbol, price_data, market_context, all_current_positions):
+                    # 本币种已下单：把刷新后的持仓并入快照，并重算组合敞口，
+                    # 让后续币种的 Prompt 看到本轮新开的相关仓位
+                    all_current_positions[symbol] = positions[symbol]
+                    update_context_positions(market_context, all_current_positions)
+        else:
+            for symbol in TRADE_CONFIG.keys():
+                run_single_strategy(symbol) # 不再传递news_text参数
 
     # 为每个配置的币种设置独立的调度任务，但指向同一个 run_all_strategies 函数
     timeframe = next(iter(TRADE_CONFIG.values()))['timeframe'] # 取第一个币种的timeframe作为调度依据
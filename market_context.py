@@ -0,0 +1,142 @@
+# market_context.py
+"""跨币种市场概况：每轮一次，用 NumPy 批量计算相关性、相对强弱与组合敞口"""
+from collections import Counter
+
+import numpy as np
+
+MIN_CONTEXT_BARS = 3 # 至少需要 3 根K线 (2 个收益率) 才能计算相关性
+
+
+def build_market_context(candles_by_symbol, positions=None, benchmark_symbol='BTC/USDT', bars=MIN_CONTEXT_BARS):
+    """根据本轮已获取的K线批量计算跨币种概况，数据不足时返回 None
+
+    candles_by_symbol: {symbol: (K线时间戳序列, 收盘价序列)}，均按时间升序
+    positions: get_positions() 的返回值 {symbol: pos 或 None}
+    bars: 使用的K线数量。不足 bars 根、或最近 bars 根K线的时间戳与多数币种
+    不一致的币种会被剔除，而不是把所有币种截短或按位置错位对齐。
+    benchmark_symbol 不在本轮数据中时，以所有币种的等权篮子作为基准。
+    """
+    bars = max(bars, MIN_CONTEXT_BARS)
+    tails = {}
+    for symbol, (timestamps, closes) in candles_by_symbol.items():
+        if timestamps is None or closes is None or len(closes) < bars or len(timestamps) != len(closes):
+            continue
+        tails[symbol] = (np.asarray(timestamps[-bars:]), np.asarray(closes[-bars:], dtype=float))
+    if len(tails) < 2:
+        return None
+    # 以多数币种共享的时间网格为准，剔除缺K线或时间错位的币种
+    grid_counts = Counter(timestamps.tobytes() for timestamps, _ in tails.values())
+    grid = grid_counts.most_common(1)[0][0]
+    symbols = [s for s, (timestamps, closes) in tails.items() if timestamps.tobytes() == grid and np.all(closes > 0)]
+    if len(symbols) < 2:
+        return None
+    prices = np.vstack([tails[s][1] for s in symbols]) # (S, bars)
+
+    # 对数收益率矩阵 (S, bars-1)
+    returns = np.diff(np.log(prices), axis=1)
+    demeaned = returns - returns.mean(axis=1, keepdims=True)
+    norms = np.sqrt((demeaned * demeaned).sum(axis=1))
+    safe_norms = np.where(norms > 0, norms, 1.0)
+    normalized = demeaned / safe_norms[:, None]
+    corr = normalized @ normalized.T
+    corr[norms == 0, :] = 0.0 # 价格无波动的币种不参与相关性
+    corr[:, norms == 0] = 0.0
+    np.clip(corr, -1.0, 1.0, out=corr)
+    np.fill_diagonal(corr, 1.0)
+
+    last_return = prices[:, -1] / prices[:, -2] - 1
+    window_return = prices[:, -1] / prices[:, 0] - 1
+
+    # 基准收益：优先使用 benchmark_symbol，否则使用等权篮子
+    if benchmark_symbol in symbols:
+        bench_idx = symbols.index(benchmark_symbol)
+        bench_returns = returns[bench_idx]
+        bench_last_return = last_return[bench_idx]
+        bench_window_return = window_return[bench_idx]
+        benchmark_name = benchmark_symbol
+    else:
+        bench_returns = returns.mean(axis=0)
+        bench_last_return = float(np.expm1(bench_returns[-1]))
+        bench_window_return = float(np.expm1(bench_returns.sum()))
+        benchmark_name = "等权篮子"
+    relative_strength = window_return - bench_window_return
+    bench_demeaned = bench_returns - bench_returns.mean()
+    bench_var = float(bench_demeaned @ bench_demeaned)
+    beta = demeaned @ bench_demeaned / bench_var if bench_var > 0 else np.zeros(len(symbols))
+
+    context = {
+        'symbols': symbols,
+        'index': {s: i for i, s in enumerate(symbols)},
+        'bars': bars,
+        'benchmark': benchmark_name,
+        'benchmark_last_return': float(bench_last_return),
+        'benchmark_window_return': float(bench_window_return),
+        'corr': corr,
+        'last_price': prices[:, -1],
+        'last_return': last_return,
+        'window_return': window_return,
+        'relative_strength': relative_strength,
+        'beta': beta,
+        'advancers': int((last_return > 0).sum()),
+        'decliners': int((last_return < 0).sum()),
+    }
+    update_context_positions(context, positions)
+    return context
+
+
+def update_context_positions(context, positions):
+    """用最新持仓重算组合敞口 (复用相关性矩阵，只需一次矩阵-向量乘法)
+
+    本轮有K线的币种按最新收盘价计价并参与相关性折算；
+    K线缺失或被剔除的持仓按入场价计价，只计入多/空/净敞口合计。
+    """
+    if not context:
+        return
+    index = context['index']
+    signed_notional = np.zeros(len(context['symbols']))
+    off_context_long = 0.0
+    off_context_short = 0.0
+    for symbol, pos in (positions or {}).items():
+        if not pos:
+            continue
+        direction = 1.0 if pos['side'] == 'long' else -1.0
+        if symbol in index:
+            i = index[symbol]
+            signed_notional[i] = direction * pos['size'] * context['last_price'][i]
+        else:
+            notional = pos['size'] * pos.get('entry_price', 0)
+            if direction > 0:
+                off_context_long += notional
+            else:
+                off_context_short += notional
+    context['signed_notional'] = signed_notional
+    # 按相关系数把所有持仓折算到每个币种上的等效敞口
+    context['correlated_exposure'] = context['corr'] @ signed_notional
+    context['long_exposure'] = float(signed_notional[signed_notional > 0].sum()) + off_context_long
+    context['short_exposure'] = float(np.abs(signed_notional[signed_notional < 0]).sum()) + off_context_short
+
+
+def format_market_context(context, symbol, top_n=3):
+    """为单个币种截取紧凑的跨币种概况文本，用于拼入 Prompt"""
+    if not context or symbol not in context['index']:
+        return ""
+    i = context['index'][symbol]
+    corr_row = context['corr'][i]
+    strength = np.abs(corr_row)
+    strength[i] = -1.0 # 排除自身
+    top_n = min(top_n, len(strength) - 1)
+    # argpartition 只取前 top_n 个，避免对整行排序
+    candidates = np.argpartition(-strength, top_n - 1)[:top_n]
+    others = candidates[np.argsort(-strength[candidates])]
+    corr_text = ", ".join(f"{context['symbols'][j]} {corr_row[j]:+.2f}" for j in others)
+    long_exposure = context['long_exposure']
+    short_exposure = context['short_exposure']
+
+    text_parts = [f"【跨币种市场概况】(最近{context['bars']}根K线)\n"]
+    text_parts.append(f"- 基准 {context['benchmark']}: 本K线 {context['benchmark_last_return'] * 100:+.2f}%, 区间 {context['benchmark_window_return'] * 100:+.2f}%\n")
+    text_parts.append(f"- 本币种: 区间 {context['window_return'][i] * 100:+.2f}%, 相对基准强弱 {context['relative_strength'][i] * 100:+.2f}%, beta {context['beta'][i]:.2f}\n")
+    text_parts.append(f"- 市场广度: 本K线上涨 {context['advancers']} 个 / 下跌 {context['decliners']} 个币种\n")
+    text_parts.append(f"- 相关性最高: {corr_text}\n")
+    text_parts.append(f"- 组合敞口: 多头 ${long_exposure:,.2f}, 空头 ${short_exposure:,.2f}, 净 ${long_exposure - short_exposure:+,.2f}\n")
+    text_parts.append(f"- 按相关性折算到本币种方向的敞口: ${context['correlated_exposure'][i]:+,.2f} (正值=组合已实际偏多本币种, 负值=偏空)")
+    return "".join(text_parts)
@@ -0,0 +1,323 @@
+# signal_parser.py
+"""LLM 交易信号解析与校验 (仅依赖标准库，便于单独基准测试)"""
+import json
+import math
+import re
+
+# --- 信号结构定义 ---
+# 字段名 -> (类型, 是否必填)。'number' 字段会被强制转换为 float。
+SIGNAL_SCHEMA = {
+    'signal': ('enum', True),
+    'reason': ('string', True),
+    'stop_loss': ('number', True),
+    'take_profit': ('number', True),
+    'confidence': ('enum', True),
+    'risk_assessment': ('string', False),
+    'position_percentage': ('number', True),
+}
+SIGNAL_ENUMS = {
+    'signal': ('BUY', 'SELL', 'HOLD'),
+    'confidence': ('HIGH', 'MEDIUM', 'LOW'),
+}
+# HOLD 信号不下单，止损/止盈/仓位可以为空
+HOLD_OPTIONAL_FIELDS = ('stop_loss', 'take_profit', 'position_percentage')
+
+# 回复模板，用于修复请求 (与主 Prompt 中的格式保持一致)
+SIGNAL_JSON_TEMPLATE = """{
+    "signal": "BUY|SELL|HOLD",
+    "reason": "分析理由",
+    "stop_loss": 数字,
+    "take_profit": 数字,
+    "confidence": "HIGH|MEDIUM|LOW",
+    "risk_assessment": "风险评估",
+    "position_percentage": 数字 (例如 3.2 表示 3.2%)
+}"""
+
+# 逗号只接受标准千分位 (1,234,567)；"1,5" 这类小数逗号会被拆成两个数字，按歧义处理
+_NUMBER_RE = re.compile(r'[-+]?(?:(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?|\.\d+)(?:[eE][-+]?\d+)?')
+_BARE_NUMBER_RE = re.compile(r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?$')
+_BARE_LITERALS = {
+    'true': 'true', 'false': 'false', 'null': 'null',
+    'True': 'true', 'False': 'false', 'None': 'null',
+    'N/A': 'null', 'n/a': 'null',
+}
+_STRUCTURAL = '{}[]:,'
+
+
+_DECODER = json.JSONDecoder()
+
+
+def _object_starts(text):
+    """依次返回回复中每个 '{' 的位置"""
+    idx = text.find('{')
+    while idx != -1:
+        yield idx
+        idx = text.find('{', idx + 1)
+
+
+def _next_significant(text, i):
+    """返回 i 之后第一个非空白字符 (无则返回空串)"""
+    n = len(text)
+    while i < n and text[i] in ' \t\r\n':
+        i += 1
+    return text[i] if i < n else ''
+
+
+def normalize_json(text):
+    """单遍扫描，把常见的非标准 JSON 改写为标准 JSON (顶层对象闭合后即停止)
+
+    处理：单引号字符串、字符串内未转义的双引号/换行、// 与 # 注释、
+    尾随逗号、未加引号的键、Python 字面量 (True/False/None)、
+    带单位的裸值 (如 3.2%、$65000)；被截断的结尾只保留能确认完整的字段。
+    """
+    out = []
+    stack = []
+    closed_string_idx = -1 # out 中最后一个已闭合字符串的位置
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if ch in '"\'':
+            # 字符串：只有后面紧跟结构字符时，同种引号才视为结束
+            quote = ch
+            i += 1
+            buf = []
+            closed = False
+            while i < n:
+                c = text[i]
+                if c == '\\' and i + 1 < n:
+                    nxt = text[i + 1]
+                    buf.append('\\' + nxt if nxt != "'" else "'")
+                    i += 2
+                    continue
+                if c == quote:
+                    follow = _next_significant(text, i + 1)
+                    if follow == '' or follow in _STRUCTURAL:
+                        i += 1
+                        closed = True
+                        break
+                if c == '"':
+                    buf.append('\\"')
+                elif c == '\n':
+                    buf.append('\\n')
+                elif c == '\r':
+                    pass
+                elif c == '\t':
+                    buf.append('\\t')
+                else:
+                    buf.append(c)
+                i += 1
+            out.append('"' + ''.join(buf) + '"')
+            if not closed:
+                break
+            closed_string_idx = len(out) - 1
+            continue
+        if ch in '{[':
+            stack.append('}' if ch == '{' else ']')
+            out.append(ch)
+            i += 1
+            continue
+        if ch in '}]':
+            # 去掉尾随逗号
+            while out and out[-1] in (',', ' '):
+                out.pop()
+            if stack:
+                stack.pop()
+            out.append(ch)
+            i += 1
+            if not stack:
+                break # 顶层对象已闭合，忽略后面的说明文字
+            continue
+        if ch in ':,':
+            out.append(ch)
+            i += 1
+            continue
+        if ch in ' \t\r\n':
+            i += 1
+            continue
+        if ch == '#' or text.startswith('//', i):
+            # 行注释
+            while i < n and text[i] != '\n':
+                i += 1
+            continue
+        if text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+            continue
+        # 裸值或未加引号的键：读到结构字符或换行为止
+        j = i
+        while j < n and text[j] not in _STRUCTURAL and text[j] != '\n':
+            if text.startswith('//', j):
+                break
+            j += 1
+            # 千分位逗号 (如 65,000.5) 属于数值本身
+            if (j < n and text[j] == ',' and text[j - 1].isdigit()
+                    and text[j + 1:j + 4].isdigit() and len(text[j + 1:j + 4]) == 3
+                    and not text[j + 4:j + 5].isdigit()):
+                j += 1
+        token = text[i:j].strip()
+        i = j
+        if not token:
+            continue
+        if _next_significant(text, i) == ':':
+            out.append(json.dumps(token, ensure_ascii=False))
+        elif token in _BARE_LITERALS:
+            out.append(_BARE_LITERALS[token])
+        elif _BARE_NUMBER_RE.match(token.lstrip('+')):
+            out.append(token.lstrip('+'))
+        else:
+            out.append(json.dumps(token, ensure_ascii=False))
+    # 补全被截断的结尾：对象未闭合时，最后一个值若不是已闭合的字符串
+    # (如 63、1e 或未闭合的字符串) 无法确认完整，整个丢弃，交给结构校验
+    if stack and len(out) >= 2 and out[-2] == ':' and closed_string_idx != len(out) - 1:
+        out.pop()
+    # 再去掉悬空的逗号/冒号，以及对象中没有值的键
+    while out:
+        if out[-1] in (',', ':'):
+            out.pop()
+        elif (stack and stack[-1] == '}' and len(out) >= 2 and out[-1].startswith('"')
+                and out[-2] in (',', '{')):
+            out.pop()
+        else:
+            break
+    while stack:
+        out.append(stack.pop())
+    return ''.join(out)
+
+
+def parse_json_reply(text):
+    """解析 LLM 回复中的 JSON 对象：先走标准 json，失败再走一次宽容改写
+
+    从每个 '{' 处尝试解码，前后的说明文字 (即使含有花括号) 不影响解析；
+    有多个对象时优先返回包含信号字段的那个。
+    """
+    starts = list(_object_starts(text))
+    if not starts:
+        raise ValueError("回复中未找到 JSON 对象")
+    fallback = None
+    for decode in (_decode_strict, _decode_tolerant):
+        for start in starts:
+            data = decode(text, start)
+            if not isinstance(data, dict):
+                continue
+            if any(field in data for field in SIGNAL_SCHEMA):
+                return data
+            if fallback is None:
+                fallback = data
+    if fallback is not None:
+        return fallback
+    raise ValueError("JSON 解析失败: 回复中没有可解析的 JSON 对象")
+
+
+def _decode_strict(text, start):
+    try:
+        return _DECODER.raw_decode(text, start)[0]
+    except json.JSONDecodeError:
+        return None
+
+
+def _decode_tolerant(text, start):
+    try:
+        return json.loads(normalize_json(text[start:]))
+    except json.JSONDecodeError:
+        return None
+
+
+def coerce_number(value):
+    """把 "$65,000.5"、"3.2%"、"65000 USDT" 之类的值转换为 float，无法转换时返回 None
+
+    字符串中出现多个不同的数字 (如 "约-1.5% 即 64000") 视为有歧义；
+    NaN 和 Infinity 一律拒绝。
+    """
+    if isinstance(value, bool):
+        return None
+    number = None
+    if isinstance(value, (int, float)):
+        number = float(value)
+    elif isinstance(value, str):
+        try:
+            number = float(value.strip().rstrip('%'))
+        except ValueError:
+            candidates = {float(m.replace(',', '')) for m in _NUMBER_RE.findall(value)}
+            if len(candidates) == 1:
+                number = candidates.pop()
+    if number is None or not math.isfinite(number):
+        return None
+    return number
+
+
+def validate_signal(data, current_price=None):
+    """按 SIGNAL_SCHEMA 校验并规范化信号，返回 (signal_data, errors)
+
+    errors 为空列表时 signal_data 可直接交给 execute_trade 使用；
+    current_price 不为空时会检查止损/止盈是否位于价格的正确一侧。
+    """
+    errors = []
+    signal_data = dict(data)
+    raw_signal = data.get('signal')
+    signal = raw_signal.strip().upper() if isinstance(raw_signal, str) else raw_signal
+    is_hold = signal == 'HOLD'
+
+    for field, (kind, required) in SIGNAL_SCHEMA.items():
+        value = data.get(field)
+        missing = value is None or (isinstance(value, str) and not value.strip())
+        if missing:
+            if required and not (is_hold and field in HOLD_OPTIONAL_FIELDS):
+                errors.append(f"缺少字段 {field}")
+            signal_data[field] = 0.0 if field == 'position_percentage' and is_hold else None
+            continue
+        if kind == 'enum':
+            normalized = value.strip().upper() if isinstance(value, str) else value
+            if normalized not in SIGNAL_ENUMS[field]:
+                errors.append(f"{field} 必须是 {'/'.join(SIGNAL_ENUMS[field])} 之一，实际为 {value!r}")
+            signal_data[field] = normalized
+        elif kind == 'number':
+            number = coerce_number(value)
+            if number is None:
+                if is_hold and field in HOLD_OPTIONAL_FIELDS:
+                    number = 0.0 if field == 'position_percentage' else None
+                else:
+                    errors.append(f"{field} 必须是数字，实际为 {value!r}")
+            signal_data[field] = number
+        else:
+            signal_data[field] = value if isinstance(value, str) else str(value)
+
+    if errors or is_hold:
+        return (None, errors) if errors else (signal_data, errors)
+
+    stop_loss = signal_data['stop_loss']
+    take_profit = signal_data['take_profit']
+    position_pct = signal_data['position_percentage']
+    if stop_loss <= 0 or take_profit <= 0:
+        errors.append("stop_loss 和 take_profit 必须为正数")
+    if not 0 < position_pct <= 100:
+        errors.append(f"position_percentage 必须在 (0, 100] 之间，实际为 {position_pct}")
+    if current_price is not None and not errors:
+        price = float(current_price)
+        if signal == 'BUY' and not stop_loss < price < take_profit:
+            errors.append(f"BUY 信号要求 stop_loss < 当前价格 {price} < take_profit，实际为 {stop_loss} / {take_profit}")
+        elif signal == 'SELL' and not take_profit < price < stop_loss:
+            errors.append(f"SELL 信号要求 take_profit < 当前价格 {price} < stop_loss，实际为 {take_profit} / {stop_loss}")
+    return (None, errors) if errors else (signal_data, errors)
+
+
+def decode_signal(text, current_price=None):
+    """解析并校验一条 LLM 回复，返回 (signal_data, errors)"""
+    try:
+        data = parse_json_reply(text)
+    except ValueError as e:
+        return None, [str(e)]
+    return validate_signal(data, current_price)
+
+
+def build_repair_prompt(bad_reply, errors):
+    """构造修复请求：只要求模型改正格式/字段，不重新分析行情"""
+    error_text = "\n".join(f"- {e}" for e in errors)
+    return f"""你上一次的回复无法被程序解析或未通过校验，问题如下：
+{error_text}
+
+上一次的回复：
+{bad_reply}
+
+请不要重新分析行情，只根据上一次回复的内容修正上述问题，并严格按以下 JSON 格式输出一个 JSON 对象，不要输出任何其他文字：
+{SIGNAL_JSON_TEMPLATE}"""